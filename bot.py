@@ -1,16 +1,25 @@
 import os
 import asyncio
 import logging
-from typing import List, Dict
+import random
+import time
+from typing import List, Dict, Tuple
 from dotenv import load_dotenv
+from dataclasses import dataclass
 from datetime import timedelta
 
 import aiohttp
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.request import HTTPXRequest
+try:
+    import uvloop
+except ImportError:  # not available on Windows; the stdlib loop is used instead
+    uvloop = None
 
-from price_sources import fetch_prices_for_token
+from price_sources import REQUEST_TIMEOUT, HttpClients, fetch_prices, usd_price
+from price_stream import PriceCache
 from compare_prices import compute_spreads, format_markdown
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -20,44 +29,102 @@ DEFAULT_THRESHOLD = float(os.getenv("THRESHOLD_PCT", "0.5"))
 DEFAULT_INTERVAL = int(os.getenv("INTERVAL_SEC", "60"))
 DEFAULT_EXCHANGES = [x.strip() for x in os.getenv("EXCHANGES", "binance,coinbase,kraken,kucoin,bybit,okx,bitstamp").split(",")]
 
+@dataclass(slots=True)
+class ChatCfg:
+    tokens: Tuple[str, ...] = tuple(DEFAULT_TOKENS)
+    exchanges: Tuple[str, ...] = tuple(DEFAULT_EXCHANGES)
+    threshold: float = DEFAULT_THRESHOLD
+    interval: int = DEFAULT_INTERVAL
+
 # Per-chat settings
-CHAT_SETTINGS: Dict[int, Dict] = {}
+CHAT_SETTINGS: Dict[int, ChatCfg] = {}
+
+def _chat_cfg(chat_id: int) -> ChatCfg:
+    cfg = CHAT_SETTINGS.get(chat_id)
+    if cfg is None:
+        cfg = CHAT_SETTINGS[chat_id] = ChatCfg()
+    return cfg
+
+def _active_chats(job_queue) -> List[ChatCfg]:
+    """Settings of chats that currently have a periodic snapshot job."""
+    return [cfg for chat_id, cfg in CHAT_SETTINGS.items() if job_queue.get_jobs_by_name(str(chat_id))]
+
+def _reschedule_fetcher(job_queue, bot_data):
+    """(Re)start the global fetcher at the smallest interval among subscribed chats, or stop it if there are none."""
+    active = _active_chats(job_queue)
+    interval = min((cfg.interval for cfg in active), default=None)
+    running = job_queue.get_jobs_by_name("__fetcher__")
+    if running and interval == bot_data.get("fetch_interval"):
+        return  # same cadence: keep the current timing instead of resetting it
+    for job in running:
+        job.schedule_removal()
+    if not active:
+        bot_data.pop("snapshot", None)
+        bot_data.pop("fetch_interval", None)
+        return
+    bot_data["fetch_interval"] = interval
+    job_queue.run_repeating(fetch_snapshot, interval=interval, first=0, name="__fetcher__")
 
-async def fetch_all_prices(session: aiohttp.ClientSession, tokens: List[str], exchanges: List[str]):
-    prices = {}
-    for t in tokens:
-        prices[t] = await fetch_prices_for_token(session, t, exchanges)
-    return prices
+async def fetch_snapshot(context: ContextTypes.DEFAULT_TYPE):
+    """Single global job: fetch prices for subscribed chats once into bot_data["snapshot"] as (ts, exchanges, prices)."""
+    tokens, exchanges = {}, {}
+    for cfg in _active_chats(context.job_queue):
+        tokens.update(dict.fromkeys(cfg.tokens))
+        exchanges.update(dict.fromkeys(cfg.exchanges))
+    if not tokens:
+        return
+    bot_data = context.application.bot_data
+    # streamed prices are read from memory; REST covers cold start and exchanges without a stream
+    prices = await fetch_prices(bot_data["http"], list(tokens), list(exchanges), bot_data.get("live"))
+    bot_data["snapshot"] = (time.monotonic(), frozenset(exchanges), prices)
 
 async def send_snapshot(context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.job.chat_id
-    cfg = CHAT_SETTINGS.get(chat_id, {})
-    tokens = cfg.get("tokens", DEFAULT_TOKENS)
-    exchanges = cfg.get("exchanges", DEFAULT_EXCHANGES)
-    threshold = cfg.get("threshold", DEFAULT_THRESHOLD)
-    async with aiohttp.ClientSession() as session:
-        prices = await fetch_all_prices(session, tokens, exchanges)
+    cfg = CHAT_SETTINGS.get(chat_id) or ChatCfg()
+    tokens, exchanges = cfg.tokens, cfg.exchanges
+    bot_data = context.application.bot_data
+    http, live = bot_data["http"], bot_data.get("live")
+    ts, covered, snapshot = bot_data.get("snapshot", (0.0, frozenset(), {}))
+    # one fetch cycle plus the time an in-progress fetch may still take
+    if time.monotonic() - ts > bot_data.get("fetch_interval", 0) + REQUEST_TIMEOUT:
+        covered, snapshot = frozenset(), {}  # fetcher idle or failing: don't serve old prices
+    # first tick or freshly changed settings: fetch what the snapshot lacks until the fetcher picks it up
+    missing_tokens = [t for t in tokens if t not in snapshot]
+    missing_exchanges = [ex for ex in exchanges if ex not in covered]
+    present_tokens = [t for t in tokens if t in snapshot]
+    jobs = []
+    if missing_tokens:
+        jobs.append(fetch_prices(http, missing_tokens, exchanges, live))
+    if missing_exchanges and present_tokens:
+        jobs.append(fetch_prices(http, present_tokens, missing_exchanges, live))
+    prices = {t: {ex: p for ex, p in snapshot.get(t, {}).items() if ex in exchanges} for t in tokens}
+    for fetched in await asyncio.gather(*jobs):
+        for t, mp in fetched.items():
+            prices[t].update(mp)
+    if live is not None:
+        # streamed prices are seconds old, the snapshot up to a fetch interval: prefer the stream
+        for t in tokens:
+            for ex in exchanges:
+                hit = live.get(ex, t)
+                if hit:
+                    prices[t][ex] = usd_price(hit)
     spreads = compute_spreads(prices)
-    text = format_markdown(prices, spreads, threshold)
+    text = format_markdown(prices, spreads, cfg.threshold)
     await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    CHAT_SETTINGS.setdefault(chat_id, {
-        "tokens": DEFAULT_TOKENS,
-        "threshold": DEFAULT_THRESHOLD,
-        "interval": DEFAULT_INTERVAL,
-        "exchanges": DEFAULT_EXCHANGES,
-    })
-    cfg = CHAT_SETTINGS[chat_id]
+    cfg = _chat_cfg(chat_id)
     # schedule periodic job
-    interval = cfg["interval"]
+    interval = cfg.interval
     # cancel previous jobs for this chat
     for job in context.job_queue.get_jobs_by_name(str(chat_id)):
         job.schedule_removal()
-    context.job_queue.run_repeating(send_snapshot, interval=interval, chat_id=chat_id, name=str(chat_id), first=1)
+    # random first run spreads chats over time instead of having them all fire together
+    context.job_queue.run_repeating(send_snapshot, interval=interval, chat_id=chat_id, name=str(chat_id), first=random.uniform(1, min(interval, 10)))
+    _reschedule_fetcher(context.job_queue, context.application.bot_data)
     await update.message.reply_text(
-        f"Бот запущен. Интервал обновления: {interval}s, порог: {cfg['threshold']}%, токены: {', '.join(cfg['tokens'])}.\n"
+        f"Бот запущен. Интервал обновления: {interval}s, порог: {cfg.threshold}%, токены: {', '.join(cfg.tokens)}.\n"
         f"Команды: /once, /set_threshold, /set_interval, /set_tokens, /set_exchanges, /status, /stop"
     )
 
@@ -65,20 +132,26 @@ async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     for job in context.job_queue.get_jobs_by_name(str(chat_id)):
         job.schedule_removal()
+    _reschedule_fetcher(context.job_queue, context.application.bot_data)
     await update.message.reply_text("Окей, автообновления остановлены. Используй /start для возобновления или /once для разового снимка.")
 
+@dataclass
+class _FakeJob:
+    chat_id: int
+
+class _Ctx:
+    """Minimal stand-in for a job callback context, used to run send_snapshot on demand."""
+    def __init__(self, bot, job, application):
+        self.bot = bot
+        self.job = job
+        self.application = application
+
 async def once(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # one-off snapshot now
     chat_id = update.effective_chat.id
-    cfg = CHAT_SETTINGS.setdefault(chat_id, {
-        "tokens": DEFAULT_TOKENS,
-        "threshold": DEFAULT_THRESHOLD,
-        "interval": DEFAULT_INTERVAL,
-        "exchanges": DEFAULT_EXCHANGES,
-    })
-    # Send snapshot
-    job_context = type("obj", (), {"job": type("obj", (), {"chat_id": chat_id})})()
-    await send_snapshot(context=type("ctx", (), {"job": job_context, "bot": context.bot})())
+    _chat_cfg(chat_id)
+    # Send snapshot; shares the HTTP session and response cache with the periodic jobs
+    await send_snapshot(_Ctx(context.bot, _FakeJob(chat_id), context.application))
 
 async def set_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -87,7 +160,7 @@ async def set_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await update.message.reply_text("Использование: /set_threshold 0.5  (в процентах)")
         return
-    CHAT_SETTINGS.setdefault(chat_id, {})["threshold"] = val
+    _chat_cfg(chat_id).threshold = val
     await update.message.reply_text(f"Порог установлен на {val}%")
 
 async def set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -97,7 +170,7 @@ async def set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await update.message.reply_text("Использование: /set_interval 60  (в секундах)")
         return
-    CHAT_SETTINGS.setdefault(chat_id, {})["interval"] = sec
+    _chat_cfg(chat_id).interval = sec
     await update.message.reply_text(f"Интервал обновления установлен на {sec} сек. Перезапусти /start чтобы применить.")
 
 async def set_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -105,8 +178,8 @@ async def set_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("Использование: /set_tokens BTC,ETH,SOL,BNB")
         return
-    tokens = [t.strip().upper() for t in " ".join(context.args).split(",") if t.strip()]
-    CHAT_SETTINGS.setdefault(chat_id, {})["tokens"] = tokens
+    tokens = tuple(t.strip().upper() for t in " ".join(context.args).split(",") if t.strip())
+    _chat_cfg(chat_id).tokens = tokens
     await update.message.reply_text(f"Токены установлены: {', '.join(tokens)}")
 
 async def set_exchanges(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -114,19 +187,19 @@ async def set_exchanges(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("Использование: /set_exchanges binance,coinbase,kraken,kucoin,bybit,okx,bitstamp")
         return
-    exchanges = [e.strip().lower() for e in " ".join(context.args).split(",") if e.strip()]
-    CHAT_SETTINGS.setdefault(chat_id, {})["exchanges"] = exchanges
+    exchanges = tuple(e.strip().lower() for e in " ".join(context.args).split(",") if e.strip())
+    _chat_cfg(chat_id).exchanges = exchanges
     await update.message.reply_text(f"Биржи установлены: {', '.join(exchanges)}")
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    cfg = CHAT_SETTINGS.get(chat_id, {})
+    cfg = CHAT_SETTINGS.get(chat_id) or ChatCfg()
     await update.message.reply_text(
         f"Текущие настройки:\n"
-        f"- tokens: {', '.join(cfg.get('tokens', []))}\n"
-        f"- exchanges: {', '.join(cfg.get('exchanges', []))}\n"
-        f"- threshold: {cfg.get('threshold', 0)}%\n"
-        f"- interval: {cfg.get('interval', 0)} сек."
+        f"- tokens: {', '.join(cfg.tokens)}\n"
+        f"- exchanges: {', '.join(cfg.exchanges)}\n"
+        f"- threshold: {cfg.threshold}%\n"
+        f"- interval: {cfg.interval} сек."
     )
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -142,12 +215,44 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/status — показать текущие настройки"
     )
 
+async def _open_http(app):
+    # long-lived clients: REST goes over per-host HTTP/2 connections, streams over one aiohttp session
+    app.bot_data["http"] = HttpClients()
+    app.bot_data["ws"] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ttl_dns_cache=300))
+    live = PriceCache()
+    live.start(app.bot_data["ws"])
+    app.bot_data["live"] = live
+
+async def _close_http(app):
+    live = app.bot_data.pop("live", None)
+    if live is not None:
+        await live.stop()
+    ws = app.bot_data.pop("ws", None)
+    if ws is not None:
+        await ws.close()
+    clients = app.bot_data.pop("http", None)
+    if clients is not None:
+        await clients.aclose()
+
 def main():
     load_dotenv()
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN не найден. Укажите его в .env")
-    app = ApplicationBuilder().token(token).build()
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        # keep PTB's default 256-connection bot pool; wait up to 30 s for a free connection
+        # during broadcast fan-out instead of failing after the default 1 s
+        .pool_timeout(30)
+        # PTB adds the long-poll timeout (30 s below) on top of this read timeout for getUpdates
+        .get_updates_request(HTTPXRequest(http_version="1.1", connection_pool_size=4, connect_timeout=10, read_timeout=5, pool_timeout=30))
+        .post_init(_open_http)
+        .post_shutdown(_close_http)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("stop", stop))
     app.add_handler(CommandHandler("once", once))
@@ -157,8 +262,24 @@ def main():
     app.add_handler(CommandHandler("set_exchanges", set_exchanges))
     app.add_handler(CommandHandler("status", status))
     app.add_handler(CommandHandler("help", help_cmd))
+    if app.job_queue is None:
+        raise RuntimeError("JobQueue недоступен. Установите python-telegram-bot[job-queue]")
+    # one fetcher for all subscribed chats (see _reschedule_fetcher); per-chat jobs only format and send from its snapshot
     # JobQueue starts automatically
-    app.run_polling(close_loop=False)
+    public_url = os.getenv("PUBLIC_URL")
+    if public_url:
+        # Telegram pushes updates to us; the token as path keeps the endpoint unguessable
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8443")),
+            url_path=token,
+            webhook_url=f"{public_url.rstrip('/')}/{token}",
+            close_loop=False,
+        )
+    else:
+        # local development without a public HTTPS endpoint
+        # long polling: one held request instead of many empty getUpdates round-trips
+        app.run_polling(timeout=30, poll_interval=0, close_loop=False)
 
 if __name__ == "__main__":
     main()
@@ -3,16 +3,21 @@ from typing import Dict, List, Tuple
 def compute_spreads(prices: Dict[str, Dict[str, float]]) -> Dict[str, Dict]:
     """ 
     prices: {token: {exchange: price_usd}}
-    returns per-token: min, max, spread_abs, spread_pct, best_buy, best_sell, table(list of tuples)
+    returns per-token: min, max, spread_abs, spread_pct, best_buy, best_sell, table
+    (table is None for tokens with data; format_markdown sorts prices[token] when rendering)
     """
     out = {}
     for token, mp in prices.items():
         if not mp:
             out[token] = {"table":[], "summary":"нет данных"}
             continue
-        items = sorted(mp.items(), key=lambda kv: kv[1])
-        min_ex, min_p = items[0]
-        max_ex, max_p = items[-1]
+        # single pass instead of a sort: the table is only sorted when rendered
+        min_ex = max_ex = None
+        for ex, p in mp.items():
+            if min_ex is None or p < min_p:
+                min_ex, min_p = ex, p
+            if max_ex is None or p >= max_p:
+                max_ex, max_p = ex, p
         spread_abs = max_p - min_p
         spread_pct = (spread_abs / min_p)*100 if min_p else 0.0
         out[token] = {
@@ -22,28 +27,31 @@ def compute_spreads(prices: Dict[str, Dict[str, float]]) -> Dict[str, Dict]:
             "spread_pct": spread_pct,
             "best_buy": (min_ex, min_p),
             "best_sell": (max_ex, max_p),
-            "table": items,
+            "table": None,  # sorted lazily by format_markdown
         }
     return out
 
 def format_markdown(prices: Dict[str, Dict[str, float]], spreads: Dict[str, Dict], threshold_pct: float) -> str:
-    lines = []
-    lines.append("📊 *Сравнение цен по биржам* (USD)")
-    for token in prices.keys():
+    lines = ["📊 *Сравнение цен по биржам* (USD)"]
+    append = lines.append
+    alert = f"\n🚨 *СПРЕД* превышает порог {threshold_pct:.3f}%"
+    for token, mp in prices.items():
         s = spreads[token]
-        lines.append(f"\n*{token}* — лучший бид/оффер и спред:")
-        if not s.get("table"):
-            lines.append("_нет данных_")
+        if "min" not in s:
+            append(f"\n*{token}* — лучший бид/оффер и спред:\n_нет данных_")
             continue
         min_ex, min_p = s["min"]
         max_ex, max_p = s["max"]
-        lines.append(f"• Лучшее место купить: *{min_ex}* — `${min_p:,.2f}`")
-        lines.append(f"• Лучшее место продать: *{max_ex}* — `${max_p:,.2f}`")
-        lines.append(f"• Разница: `${s['spread_abs']:,.2f}` ({s['spread_pct']:.3f}%)")
-        if s['spread_pct'] >= threshold_pct:
-            lines.append(f"🚨 *СПРЕД* превышает порог {threshold_pct:.3f}%")
+        sp_pct = s["spread_pct"]
+        append(
+            f"\n*{token}* — лучший бид/оффер и спред:\n"
+            f"• Лучшее место купить: *{min_ex}* — `${min_p:,.2f}`\n"
+            f"• Лучшее место продать: *{max_ex}* — `${max_p:,.2f}`\n"
+            f"• Разница: `${s['spread_abs']:,.2f}` ({sp_pct:.3f}%)"
+            f"{alert if sp_pct >= threshold_pct else ''}\n"
+            "Биржи:"
+        )
         # table
-        lines.append("Биржи:")
-        for ex, p in s["table"]:
-            lines.append(f"  - `{ex}` — `${p:,.2f}`")
+        for ex, p in s["table"] or sorted(mp.items(), key=lambda kv: kv[1]):
+            append(f"  - `{ex}` — `${p:,.2f}`")
     return "\n".join(lines)
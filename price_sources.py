@@ -1,6 +1,19 @@
 import asyncio
-import aiohttp
-from typing import Dict, Optional, Tuple
+import time
+import httpx
+import orjson
+from collections import defaultdict
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+# Total timeout of a single REST request, in seconds
+REQUEST_TIMEOUT = 8.0
+# Max concurrent REST requests per exchange host; also the size of each host's connection pool
+LIMIT_PER_HOST = 6
+
+# Response cache TTLs in seconds. USDT-USD barely moves, so it can be kept much longer than tickers.
+PRICE_TTL = 5.0
+USDT_RATE_TTL = 60.0
 
 # Normalize token symbols per exchange (base-quote pairs)
 # We try to fetch USD or USDT quotes; if USDT we will convert to USD using a USDT-USD rate.
@@ -43,34 +56,140 @@ SYMBOLS = {
     },
 }
 
+def quote_for(symbol: str) -> str:
+    """Quote currency of an exchange symbol: USDT pairs need conversion, everything else is USD."""
+    return "USDT" if symbol.upper().endswith("USDT") else "USD"
+
+# (token, exchange) -> symbol, only for pairs that are actually listed
+FLAT: Dict[Tuple[str, str], str] = {(t, ex): sym for t, m in SYMBOLS.items() for ex, sym in m.items() if sym}
+
+# Request URLs and query params built once per known symbol instead of on every tick
+def _per_symbol(ex: str, make) -> Dict[str, Any]:
+    return {sym: make(sym) for (_, e), sym in FLAT.items() if e == ex}
+
+def _coinbase_url(symbol: str) -> str:
+    return f"https://api.exchange.coinbase.com/products/{symbol}/ticker"
+
+def _bitstamp_url(symbol: str) -> str:
+    return f"https://www.bitstamp.net/api/v2/ticker/{symbol}"
+
+def _kraken_params(symbol: str) -> dict:
+    return {"pair": symbol}
+
+def _kucoin_params(symbol: str) -> dict:
+    return {"symbol": symbol}
+
+USDT_USD_URL = _coinbase_url("USDT-USD")
+COINBASE_URLS = _per_symbol("coinbase", _coinbase_url)
+BITSTAMP_URLS = _per_symbol("bitstamp", _bitstamp_url)
+KRAKEN_PARAMS = _per_symbol("kraken", _kraken_params)
+KUCOIN_PARAMS = _per_symbol("kucoin", _kucoin_params)
+BYBIT_SPOT_PARAMS = {"category": "spot"}
+OKX_SPOT_PARAMS = {"instType": "SPOT"}
+
+# host -> semaphore bounding requests in flight, so fan-out waits here instead of on the pool
+_HOST_SEM: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(LIMIT_PER_HOST))
+
+class HttpClients:
+    """One HTTP/2 client per exchange host, so concurrent requests multiplex over a single connection."""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def for_host(self, host: str) -> httpx.AsyncClient:
+        client = self._clients.get(host)
+        if client is None:
+            client = self._clients[host] = httpx.AsyncClient(
+                http2=True,
+                # pool matches the per-host semaphore; redirects followed as aiohttp did
+                limits=httpx.Limits(max_connections=LIMIT_PER_HOST, max_keepalive_connections=LIMIT_PER_HOST),
+                timeout=REQUEST_TIMEOUT,
+                follow_redirects=True,
+            )
+        return client
+
+    async def aclose(self):
+        await asyncio.gather(*(c.aclose() for c in self._clients.values()))
+        self._clients.clear()
+
 # Helper: fetch JSON with timeout and graceful error handling
-async def _get_json(session: aiohttp.ClientSession, url: str, params=None, headers=None):
+async def _fetch_json(session: HttpClients, url: str, params=None, headers=None):
+    host = urlparse(url).netloc
     try:
-        async with session.get(url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=8)) as r:
-            if r.status != 200:
-                return None
-            return await r.json(content_type=None)
+        async with _HOST_SEM[host]:
+            r = await session.for_host(host).get(url, params=params, headers=headers)
+        if r.status_code != 200:
+            return None
+        return orjson.loads(r.content)
     except Exception:
         return None
 
-async def fetch_usdt_usd_rate(session: aiohttp.ClientSession) -> float:
-    """Fetch USDT-USD rate from Coinbase (close to 1)."""
-    data = await _get_json(session, "https://api.exchange.coinbase.com/products/USDT-USD/ticker")
-    if data and "price" in data:
-        return float(data["price"])
-    # Fallback 1.0 if API unavailable
-    return 1.0
+_Key = Tuple[str, Tuple[Tuple[str, Any], ...]]
+
+# key -> (monotonic timestamp, decoded JSON); only successful responses are stored
+_CACHE: Dict[_Key, Tuple[float, Any]] = {}
+# key -> task of a request currently on the wire, shared by concurrent callers
+_INFLIGHT: Dict[_Key, asyncio.Future] = {}
+
+def _cache_key(url: str, params=None) -> _Key:
+    return url, tuple(sorted(params.items())) if params else ()
+
+async def _fetch_and_cache(key: _Key, session: HttpClients, url: str, params, headers):
+    try:
+        data = await _fetch_json(session, url, params, headers)
+        if data is not None:
+            _CACHE[key] = (time.monotonic(), data)
+        return data
+    finally:
+        _INFLIGHT.pop(key, None)
+
+# Helper: fetch JSON with a short TTL cache; concurrent identical requests share one GET
+async def _get_json(session: HttpClients, url: str, params=None, headers=None, ttl: float = PRICE_TTL):
+    key = _cache_key(url, params)
+    hit = _CACHE.get(key)
+    if hit and time.monotonic() - hit[0] < ttl:
+        return hit[1]
+    fut = _INFLIGHT.get(key)
+    if fut is None:
+        # the request runs as its own task so cancelling one caller doesn't cancel it for the others
+        fut = _INFLIGHT[key] = asyncio.ensure_future(_fetch_and_cache(key, session, url, params, headers))
+    return await asyncio.shield(fut)
+
+# Process-wide USDT-USD rate, shared by every token of every snapshot
+_usdt_cache = {"ts": 0.0, "val": 1.0}
+_usdt_lock = asyncio.Lock()
+
+async def fetch_usdt_usd_rate(session: HttpClients) -> float:
+    """Fetch USDT-USD rate from Coinbase (close to 1), cached for USDT_RATE_TTL seconds."""
+    if time.monotonic() - _usdt_cache["ts"] < USDT_RATE_TTL:
+        return _usdt_cache["val"]
+    async with _usdt_lock:
+        # another caller may have refreshed it while we waited for the lock
+        if time.monotonic() - _usdt_cache["ts"] < USDT_RATE_TTL:
+            return _usdt_cache["val"]
+        data = await _get_json(session, USDT_USD_URL, ttl=USDT_RATE_TTL)
+        if data and "price" in data:
+            _usdt_cache["val"] = float(data["price"])
+            _usdt_cache["ts"] = time.monotonic()
+            return _usdt_cache["val"]
+    # Fallback to the last known rate (1.0 initially) if API unavailable
+    return _usdt_cache["val"]
+
+def usd_price(quote_price: Tuple[float, str]) -> float:
+    """Convert a (price, quote) pair to USD using the last known USDT-USD rate."""
+    price, quote = quote_price
+    return price * _usdt_cache["val"] if quote == "USDT" else price
 
 async def binance_price(session, symbol: str) -> Optional[Tuple[float, str]]:
     data = await _get_json(session, "https://api.binance.com/api/v3/ticker/price", params={"symbol": symbol})
     if not data or "price" not in data:
         return None
-    return float(data["price"]), "USDT" if symbol.endswith("USDT") else "USD"
+    return float(data["price"]), quote_for(symbol)
 
 async def coinbase_price(session, symbol: str) -> Optional[Tuple[float, str]]:
     if symbol is None: 
         return None
-    data = await _get_json(session, f"https://api.exchange.coinbase.com/products/{symbol}/ticker")
+    data = await _get_json(session, COINBASE_URLS.get(symbol) or _coinbase_url(symbol))
     if not data or "price" not in data:
         return None
     return float(data["price"]), "USD"
@@ -78,7 +197,7 @@ async def coinbase_price(session, symbol: str) -> Optional[Tuple[float, str]]:
 async def kraken_price(session, symbol: str) -> Optional[Tuple[float, str]]:
     if symbol is None:
         return None
-    data = await _get_json(session, "https://api.kraken.com/0/public/Ticker", params={"pair": symbol})
+    data = await _get_json(session, "https://api.kraken.com/0/public/Ticker", params=KRAKEN_PARAMS.get(symbol) or _kraken_params(symbol))
     if not data or "result" not in data or not data["result"]:
         return None
     key = list(data["result"].keys())[0]
@@ -86,10 +205,10 @@ async def kraken_price(session, symbol: str) -> Optional[Tuple[float, str]]:
     return price, "USD"
 
 async def kucoin_price(session, symbol: str) -> Optional[Tuple[float, str]]:
-    data = await _get_json(session, "https://api.kucoin.com/api/v1/market/orderbook/level1", params={"symbol": symbol})
+    data = await _get_json(session, "https://api.kucoin.com/api/v1/market/orderbook/level1", params=KUCOIN_PARAMS.get(symbol) or _kucoin_params(symbol))
     if not data or "data" not in data or "price" not in data["data"]:
         return None
-    return float(data["data"]["price"]), "USDT" if symbol.endswith("USDT") else "USD"
+    return float(data["data"]["price"]), quote_for(symbol)
 
 async def bybit_price(session, symbol: str) -> Optional[Tuple[float, str]]:
     # spot ticker
@@ -97,7 +216,7 @@ async def bybit_price(session, symbol: str) -> Optional[Tuple[float, str]]:
     try:
         if data and data.get("result", {}).get("list"):
             price = float(data["result"]["list"][0]["lastPrice"])
-            return price, "USDT" if symbol.endswith("USDT") else "USD"
+            return price, quote_for(symbol)
     except Exception:
         return None
     return None
@@ -107,7 +226,7 @@ async def okx_price(session, symbol: str) -> Optional[Tuple[float, str]]:
     try:
         if data and data.get("data"):
             price = float(data["data"][0]["last"])
-            return price, "USDT" if symbol.endswith("USDT") else "USD"
+            return price, quote_for(symbol)
     except Exception:
         return None
     return None
@@ -115,11 +234,36 @@ async def okx_price(session, symbol: str) -> Optional[Tuple[float, str]]:
 async def bitstamp_price(session, symbol: str) -> Optional[Tuple[float, str]]:
     if symbol is None:
         return None
-    data = await _get_json(session, f"https://www.bitstamp.net/api/v2/ticker/{symbol}")
+    data = await _get_json(session, BITSTAMP_URLS.get(symbol) or _bitstamp_url(symbol))
     if not data or "last" not in data:
         return None
     return float(data["last"]), "USD"
 
+# Bulk fetchers: one request for many symbols, returning symbol -> last price (quote follows from the symbol)
+async def binance_prices_bulk(session, symbols: list) -> Dict[str, float]:
+    data = await _get_json(session, "https://api.binance.com/api/v3/ticker/price",
+                           params={"symbols": orjson.dumps(sorted(symbols)).decode()})
+    if not isinstance(data, list):
+        return {}
+    return {d["symbol"]: float(d["price"]) for d in data if "price" in d}
+
+async def bybit_tickers_bulk(session, symbols: list) -> Dict[str, float]:
+    # Bybit takes a single symbol only, but without one it returns the whole spot list
+    data = await _get_json(session, "https://api.bybit.com/v5/market/tickers", params=BYBIT_SPOT_PARAMS)
+    wanted = set(symbols)
+    try:
+        return {d["symbol"]: float(d["lastPrice"]) for d in data["result"]["list"] if d["symbol"] in wanted}
+    except Exception:
+        return {}
+
+async def okx_tickers_bulk(session, symbols: list) -> Dict[str, float]:
+    data = await _get_json(session, "https://www.okx.com/api/v5/market/tickers", params=OKX_SPOT_PARAMS)
+    wanted = set(symbols)
+    try:
+        return {d["instId"]: float(d["last"]) for d in data["data"] if d["instId"] in wanted}
+    except Exception:
+        return {}
+
 EXCHANGES = {
     "binance": binance_price,
     "coinbase": coinbase_price,
@@ -130,31 +274,63 @@ EXCHANGES = {
     "bitstamp": bitstamp_price,
 }
 
-async def fetch_prices_for_token(session: aiohttp.ClientSession, token: str, exchanges: list) -> Dict[str, float]:
-    """Return mapping exchange -> price in USD for the given token."""
-    tasks = []
-    usdt_rate_task = asyncio.create_task(fetch_usdt_usd_rate(session))
+BULK = {
+    "binance": binance_prices_bulk,
+    "bybit": bybit_tickers_bulk,
+    "okx": okx_tickers_bulk,
+}
+
+async def fetch_prices(session: HttpClients, tokens: list, exchanges: list, live=None) -> Dict[str, Dict[str, float]]:
+    """Return mapping token -> exchange -> price in USD.
+
+    Exchanges listed in BULK are queried once for all tokens, the rest once per token.
+    live: optional price_stream.PriceCache; fresh streamed prices are used as is
+    and REST is only queried for pairs the stream has no fresh price for.
+    """
+    quotes = {}  # (token, ex) -> (price, quote)
+    bulk = {}    # ex -> {symbol: token}
+    single = []  # (token, ex, fn, symbol)
     for ex in exchanges:
-        sym = SYMBOLS.get(token, {}).get(ex)
         fn = EXCHANGES.get(ex)
-        if not fn or sym is None:
+        if not fn:
             continue
-        tasks.append(asyncio.create_task(fn(session, sym)))
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    usdt_usd = await usdt_rate_task
-    out = {}
-    i = 0
-    for ex in exchanges:
-        sym = SYMBOLS.get(token, {}).get(ex)
-        fn = EXCHANGES.get(ex)
-        if not fn or sym is None:
+        for t in tokens:
+            sym = FLAT.get((t, ex))
+            if not sym:
+                continue
+            hit = live.get(ex, t) if live is not None else None
+            if hit:
+                quotes[(t, ex)] = hit
+            elif ex in BULK:
+                bulk.setdefault(ex, {})[sym] = t
+            else:
+                single.append((t, ex, fn, sym))
+    # the USDT-USD rate (usually cached) is fetched alongside the exchanges, not after them
+    usdt_usd, *results = await asyncio.gather(
+        fetch_usdt_usd_rate(session),
+        *(BULK[ex](session, list(syms)) for ex, syms in bulk.items()),
+        *(fn(session, sym) for _, _, fn, sym in single),
+        return_exceptions=True,
+    )
+    if isinstance(usdt_usd, Exception):
+        usdt_usd = _usdt_cache["val"]
+    for (ex, syms), res in zip(bulk.items(), results):
+        if isinstance(res, Exception) or not res:
             continue
-        res = results[i]
-        i += 1
+        for sym, price in res.items():
+            t = syms.get(sym)
+            if t:
+                quotes[(t, ex)] = price, quote_for(sym)
+    for (t, ex, _, _), res in zip(single, results[len(bulk):]):
         if isinstance(res, Exception) or res is None:
             continue
-        price, quote = res
-        if quote == "USDT":
-            price = price * usdt_usd
-        out[ex] = price
+        quotes[(t, ex)] = res
+    out = {t: {} for t in tokens}
+    for ex in exchanges:
+        for t in tokens:
+            q = quotes.get((t, ex))
+            if q is None:
+                continue
+            price, quote = q
+            out[t][ex] = price * usdt_usd if quote == "USDT" else price
     return out
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+import aiohttp
+import orjson
+from typing import Dict, Optional, Tuple
+
+from price_sources import SYMBOLS, quote_for
+
+log = logging.getLogger(__name__)
+
+# Streamed prices older than this are ignored and the REST fetchers are used instead
+STREAM_MAX_AGE = 30.0
+# Delay before reconnecting a dropped stream
+RECONNECT_DELAY = 5.0
+
+def _symbols_for(ex: str) -> Dict[str, str]:
+    """Return mapping exchange symbol -> token for every token listed on the exchange."""
+    return {m[ex]: token for token, m in SYMBOLS.items() if m.get(ex)}
+
+class PriceCache:
+    """Local price table kept up to date by exchange WebSocket ticker streams.
+
+    prices: {(exchange, token): ((price, quote), monotonic timestamp)}
+    """
+
+    def __init__(self, max_age: float = STREAM_MAX_AGE):
+        self.max_age = max_age
+        self.prices: Dict[Tuple[str, str], Tuple[Tuple[float, str], float]] = {}
+        self._tasks = []
+
+    def get(self, ex: str, token: str) -> Optional[Tuple[float, str]]:
+        """Return (price, quote) if a fresh streamed price exists, otherwise None."""
+        hit = self.prices.get((ex, token))
+        if hit and time.monotonic() - hit[1] < self.max_age:
+            return hit[0]
+        return None
+
+    def _put(self, ex: str, token: str, price, symbol: str):
+        self.prices[(ex, token)] = ((float(price), quote_for(symbol)), time.monotonic())
+
+    def start(self, session: aiohttp.ClientSession):
+        for stream in (self._binance, self._bybit, self._okx, self._coinbase):
+            self._tasks.append(asyncio.create_task(self._run(session, stream)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self, session, stream):
+        # keep the stream alive forever; any error just triggers a reconnect
+        while True:
+            try:
+                await stream(session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("%s stream dropped: %s", stream.__name__.lstrip("_"), e)
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _messages(self, session, url: str, subscribe=None):
+        async with session.ws_connect(url, heartbeat=20) as ws:
+            if subscribe is not None:
+                await ws.send_json(subscribe)
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                yield orjson.loads(msg.data)
+
+    async def _binance(self, session):
+        syms = _symbols_for("binance")
+        streams = "/".join(f"{s.lower()}@ticker" for s in syms)
+        async for data in self._messages(session, f"wss://stream.binance.com:9443/stream?streams={streams}"):
+            d = data.get("data") or {}
+            token = syms.get(d.get("s"))
+            if token and "c" in d:
+                self._put("binance", token, d["c"], d["s"])
+
+    async def _bybit(self, session):
+        syms = _symbols_for("bybit")
+        sub = {"op": "subscribe", "args": [f"tickers.{s}" for s in syms]}
+        async for data in self._messages(session, "wss://stream.bybit.com/v5/public/spot", sub):
+            d = data.get("data") or {}
+            token = syms.get(d.get("symbol"))
+            if token and "lastPrice" in d:
+                self._put("bybit", token, d["lastPrice"], d["symbol"])
+
+    async def _okx(self, session):
+        syms = _symbols_for("okx")
+        sub = {"op": "subscribe", "args": [{"channel": "tickers", "instId": s} for s in syms]}
+        async for data in self._messages(session, "wss://ws.okx.com:8443/ws/v5/public", sub):
+            for d in data.get("data") or []:
+                token = syms.get(d.get("instId"))
+                if token and "last" in d:
+                    self._put("okx", token, d["last"], d["instId"])
+
+    async def _coinbase(self, session):
+        syms = _symbols_for("coinbase")
+        sub = {"type": "subscribe", "product_ids": list(syms), "channels": ["ticker"]}
+        async for data in self._messages(session, "wss://ws-feed.exchange.coinbase.com", sub):
+            if data.get("type") != "ticker":
+                continue
+            token = syms.get(data.get("product_id"))
+            if token and "price" in data:
+                self._put("coinbase", token, data["price"], data["product_id"])